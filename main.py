@@ -2,15 +2,27 @@ import os
 import asyncio
 import logging
 import secrets
+import hmac
+import time
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakValueDictionary
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from pathlib import Path
 
-from fastapi import FastAPI, Request, HTTPException
+import ahocorasick
+import orjson
+from fastapi import FastAPI, Request, HTTPException, Response
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, Date, ForeignKey, Text, Index, select, func, tuple_, delete, event, bindparam
+from sqlalchemy import update as sql_update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,12 +34,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
-ADMIN_IDS = set(int(x.strip()) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip())
-DB_URL = "sqlite:///./bot.db"
+ADMIN_IDS = frozenset(int(x.strip()) for x in os.getenv("ADMIN_ID", "").split(",") if x.strip())
+DB_URL = "sqlite+aiosqlite:///./bot.db"
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", secrets.token_urlsafe(32))
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
 UPLOAD_PATH = os.getenv("UPLOAD_PATH", "./uploads")
 PORT = int(os.getenv("PORT", "5000"))
+ADMIN_STATE_TTL = 15 * 60
+BROADCAST_CONCURRENCY = 20
+UPDATE_WORKERS = int(os.getenv("WORKERS", "16"))
+UPDATE_QUEUE_SIZE = 10_000
+BROADCAST_CHUNK_SIZE = 500
+LEADERBOARD_CACHE_TTL = 60
 
 Path(UPLOAD_PATH).mkdir(parents=True, exist_ok=True)
 
@@ -36,10 +55,11 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, index=True, nullable=True)
+    telegram_id = Column(BigInteger, unique=True, index=True, nullable=True)
     username = Column(String, index=True, nullable=True)
     first_seen = Column(DateTime, default=datetime.utcnow)
     last_seen = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (Index("ix_users_username_lower", func.lower(username)),)
 
 class Message(Base):
     __tablename__ = "messages"
@@ -52,24 +72,35 @@ class Message(Base):
     file_path = Column(String, nullable=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
     seen_by_admin = Column(Boolean, default=False)
-    user = relationship("User")
+    user = relationship("User", lazy="raise")
+    __table_args__ = (
+        Index("ix_msg_unread", "user_id", "from_admin", "seen_by_admin"),
+        Index("ix_msg_user_ts", "user_id", "timestamp"),
+    )
 
 class AdminSession(Base):
     __tablename__ = "admin_sessions"
     id = Column(Integer, primary_key=True)
-    admin_id = Column(Integer)
+    admin_id = Column(BigInteger)
     active_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     active_group_id = Column(Integer, ForeignKey("groups.id"), nullable=True)
     session_type = Column(String, default="user")
     is_active = Column(Boolean, default=False)
     started_at = Column(DateTime, nullable=True)
     ended_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_admin_sessions_active", "is_active", "admin_id"),
+        Index(
+            "ux_admin_sessions_one_active", admin_id, unique=True,
+            sqlite_where=is_active == True, postgresql_where=is_active == True
+        ),
+    )
 
 class UserQueue(Base):
     __tablename__ = "user_queue"
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 class AutoReply(Base):
     __tablename__ = "auto_replies"
@@ -82,7 +113,7 @@ class AutoReply(Base):
 class Group(Base):
     __tablename__ = "groups"
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, index=True)
+    telegram_id = Column(BigInteger, unique=True, index=True)
     title = Column(String)
     username = Column(String, nullable=True)
     bot_has_admin = Column(Boolean, default=False)
@@ -93,18 +124,27 @@ class GroupMessage(Base):
     __tablename__ = "group_messages"
     id = Column(Integer, primary_key=True)
     group_id = Column(Integer, ForeignKey("groups.id"))
-    user_id = Column(Integer, nullable=True)
+    user_id = Column(BigInteger, nullable=True)
     username = Column(String, nullable=True)
     content_type = Column(String)
     text = Column(Text, nullable=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
-    group = relationship("Group")
+    group = relationship("Group", lazy="raise")
+    __table_args__ = (Index("ix_gm_group_ts", "group_id", "timestamp"),)
+
+class DailyGroupCount(Base):
+    __tablename__ = "daily_group_counts"
+    group_id = Column(Integer, ForeignKey("groups.id"), primary_key=True)
+    username = Column(String, primary_key=True, default="")
+    day = Column(Date, primary_key=True)
+    message_count = Column(Integer, default=0)
+    __table_args__ = (Index("ix_daily_counts_group_day", "group_id", "day"),)
 
 class MutedUser(Base):
     __tablename__ = "muted_users"
     id = Column(Integer, primary_key=True)
     group_id = Column(Integer, ForeignKey("groups.id"))
-    user_id = Column(Integer)
+    user_id = Column(BigInteger)
     username = Column(String, nullable=True)
     muted_until = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -113,60 +153,191 @@ class BannedUser(Base):
     __tablename__ = "banned_users"
     id = Column(Integer, primary_key=True)
     group_id = Column(Integer, ForeignKey("groups.id"))
-    user_id = Column(Integer)
+    user_id = Column(BigInteger)
     username = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 if "sqlite" in DB_URL:
-    engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+    engine = create_async_engine(
+        DB_URL,
+        connect_args={"check_same_thread": False, "timeout": 30},
+        pool_size=10,
+        max_overflow=20,
+        query_cache_size=1200
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
 else:
-    engine = create_engine(DB_URL)
+    engine = create_async_engine(
+        DB_URL,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+        query_cache_size=1200
+    )
 
-SessionLocal = sessionmaker(bind=engine)
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
-def init_db():
-    Base.metadata.create_all(engine)
+SELECT_USER_BY_TG_ID = select(User).where(User.telegram_id == bindparam("telegram_id"))
+SELECT_ACTIVE_SESSION = select(AdminSession).where(
+    AdminSession.admin_id == bindparam("admin_id"),
+    AdminSession.is_active.is_(True)
+)
+SELECT_GROUP_BY_TG_ID = select(Group).where(Group.telegram_id == bindparam("telegram_id"))
+DEQUEUE_NEXT_USER = delete(UserQueue).where(
+    UserQueue.id == select(UserQueue.id).order_by(UserQueue.created_at).limit(1).scalar_subquery()
+).returning(UserQueue.user_id)
+
+def create_indexes(conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+async def optimize_db():
+    if "sqlite" not in DB_URL:
+        return
+    try:
+        async with engine.begin() as conn:
+            await conn.exec_driver_sql("PRAGMA analysis_limit=400")
+            has_stats = (await conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            )).scalar()
+            await conn.exec_driver_sql("PRAGMA optimize=0x10002" if has_stats else "ANALYZE")
+    except Exception as e:
+        logger.error(f"Error optimizing database: {e}")
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(sql_update(AdminSession).where(
+            AdminSession.is_active.is_(True),
+            AdminSession.id.not_in(
+                select(func.max(AdminSession.id))
+                .where(AdminSession.is_active.is_(True))
+                .group_by(AdminSession.admin_id)
+            )
+        ).values(is_active=False, ended_at=datetime.utcnow()))
+        await conn.run_sync(create_indexes)
 
 app = FastAPI()
 bot_app: Optional[Application] = None
-session_lock = asyncio.Lock()
+user_locks = WeakValueDictionary()
 
+background_tasks = set()
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+update_workers = []
+file_io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="file-io")
+broadcast_semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+active_user_sessions = {}
+active_group_sessions = {}
+leaderboard_cache = {}
 admin_state = {}
 
-def get_or_create_user(db, tg_user):
-    user = db.query(User).filter_by(telegram_id=tg_user.id).first()
+_auto_reply_cache: Optional[Tuple[Dict[str, Tuple[str, Optional[str]]], ahocorasick.Automaton]] = None
+_auto_reply_lock = asyncio.Lock()
+_auto_reply_generation = 0
+
+async def get_or_create_user(db, tg_user):
+    user = await db.scalar(SELECT_USER_BY_TG_ID, {"telegram_id": tg_user.id})
     
     if not user:
         username = getattr(tg_user, "username", None)
         if username:
-            from sqlalchemy import func
-            user = db.query(User).filter(
+            user = await db.scalar(select(User).filter(
                 func.lower(User.username) == username.lower(),
                 User.telegram_id.is_(None)
-            ).first()
+            ))
             if user:
                 user.telegram_id = tg_user.id
                 user.username = username
                 user.last_seen = datetime.utcnow()
-                db.commit()
-                db.refresh(user)
+                await db.commit()
+                await db.refresh(user)
                 return user
         
         user = User(telegram_id=tg_user.id, username=username)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
     else:
         user.last_seen = datetime.utcnow()
         user.username = getattr(tg_user, "username", user.username)
-        db.commit()
+        await db.commit()
     return user
 
-def get_active_session(db, admin_id):
-    return db.query(AdminSession).filter_by(admin_id=admin_id, is_active=True).first()
+async def get_active_session(db, admin_id):
+    return await db.scalar(SELECT_ACTIVE_SESSION, {"admin_id": admin_id})
+
+def lock_for(telegram_id: int):
+    lock = user_locks.get(telegram_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[telegram_id] = lock
+    return lock
+
+def track_session(session):
+    if session.session_type == "group":
+        active_group_sessions[session.active_group_id] = session.admin_id
+    elif session.active_user_id:
+        active_user_sessions[session.active_user_id] = session.admin_id
 
-def get_or_create_group(db, tg_chat):
-    group = db.query(Group).filter_by(telegram_id=tg_chat.id).first()
+def untrack_session(session):
+    if session.session_type == "group":
+        sessions, key = active_group_sessions, session.active_group_id
+    else:
+        sessions, key = active_user_sessions, session.active_user_id
+    if sessions.get(key) == session.admin_id:
+        del sessions[key]
+
+async def load_active_sessions(db):
+    active_user_sessions.clear()
+    active_group_sessions.clear()
+    sessions = (await db.scalars(select(AdminSession).filter(
+        AdminSession.is_active.is_(True),
+        AdminSession.admin_id.in_(ADMIN_IDS)
+    ))).all()
+    for session in sessions:
+        track_session(session)
+
+async def backfill_daily_group_counts(db):
+    if await db.scalar(select(DailyGroupCount.group_id).limit(1)) is not None:
+        return
+    day = func.date(GroupMessage.timestamp)
+    username = func.coalesce(GroupMessage.username, "")
+    await db.execute(sqlite_insert(DailyGroupCount).from_select(
+        ["group_id", "username", "day", "message_count"],
+        select(GroupMessage.group_id, username, day, func.count(GroupMessage.id))
+        .group_by(GroupMessage.group_id, username, day)
+    ))
+    await db.commit()
+
+def get_admin_state(admin_id: int):
+    entry = admin_state.get(admin_id)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def set_admin_state(admin_id: int, state: dict):
+    now = time.monotonic()
+    for stale in [k for k, (expires, _) in admin_state.items() if expires <= now]:
+        del admin_state[stale]
+    admin_state[admin_id] = (now + ADMIN_STATE_TTL, state)
+
+def clear_admin_state(admin_id: int):
+    admin_state.pop(admin_id, None)
+
+async def get_or_create_group(db, tg_chat):
+    group = await db.scalar(SELECT_GROUP_BY_TG_ID, {"telegram_id": tg_chat.id})
     
     if not group:
         group = Group(
@@ -175,28 +346,49 @@ def get_or_create_group(db, tg_chat):
             username=getattr(tg_chat, "username", None)
         )
         db.add(group)
-        db.commit()
-        db.refresh(group)
+        await db.commit()
+        await db.refresh(group)
     else:
         group.last_seen = datetime.utcnow()
         group.title = tg_chat.title
-        db.commit()
+        await db.commit()
     return group
 
-def admin_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("👥 Users", callback_data="users_page_1"),
-         InlineKeyboardButton("👁 View @username", callback_data="view_user")],
-        [InlineKeyboardButton("👪 Groups", callback_data="groups_page_1"),
-         InlineKeyboardButton("💬 Start live @username", callback_data="start_live")],
-        [InlineKeyboardButton("🗑 Delete all chats", callback_data="delete_all"),
-         InlineKeyboardButton("🗑 Delete @username", callback_data="delete_user")],
-        [InlineKeyboardButton("🛑 End live session", callback_data="end_live"),
-         InlineKeyboardButton("📊 Leaderboard", callback_data="leaderboard_menu")],
-        [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast"),
-         InlineKeyboardButton("🤖 Auto replies", callback_data="auto_replies")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+ADMIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👥 Users", callback_data="users_page_1"),
+     InlineKeyboardButton("👁 View @username", callback_data="view_user")],
+    [InlineKeyboardButton("👪 Groups", callback_data="groups_page_1"),
+     InlineKeyboardButton("💬 Start live @username", callback_data="start_live")],
+    [InlineKeyboardButton("🗑 Delete all chats", callback_data="delete_all"),
+     InlineKeyboardButton("🗑 Delete @username", callback_data="delete_user")],
+    [InlineKeyboardButton("🛑 End live session", callback_data="end_live"),
+     InlineKeyboardButton("📊 Leaderboard", callback_data="leaderboard_menu")],
+    [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast"),
+     InlineKeyboardButton("🤖 Auto replies", callback_data="auto_replies")]
+])
+
+DELETE_ALL_CONFIRM_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Yes, delete all", callback_data="confirm_delete_all"),
+     InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+])
+
+MEDALS = ("🥇", "🥈", "🥉")
+
+BACK_ROW = (InlineKeyboardButton("🔙 Back to menu", callback_data="cancel"),)
+
+LEADERBOARD_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Day Leaders", callback_data="lb_day"),
+     InlineKeyboardButton("📊 Week Leaders", callback_data="lb_week")],
+    [InlineKeyboardButton("📊 Month Leaders", callback_data="lb_month")],
+    BACK_ROW
+])
+
+AUTO_REPLIES_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add Auto Reply", callback_data="add_auto_reply")],
+    [InlineKeyboardButton("➖ Delete Auto Reply", callback_data="delete_auto_reply")],
+    [InlineKeyboardButton("📋 List Auto Replies", callback_data="list_auto_replies")],
+    BACK_ROW
+])
 
 async def download_file(file_id: str, file_type: str):
     try:
@@ -204,42 +396,48 @@ async def download_file(file_id: str, file_type: str):
         file_extension = file.file_path.split('.')[-1] if '.' in file.file_path else file_type
         local_filename = f"{file_id}.{file_extension}"
         local_path = os.path.join(UPLOAD_PATH, local_filename)
-        await file.download_to_drive(local_path)
+        data = await file.download_as_bytearray()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(file_io_executor, Path(local_path).write_bytes, data)
         return local_path
     except Exception as e:
         logger.error(f"Error downloading file: {e}")
         return None
 
+async def persist_file(message_id: int, file_id: str, file_type: str):
+    local_path = await download_file(file_id, file_type)
+    if local_path:
+        async with AsyncSessionLocal() as db:
+            await db.execute(sql_update(Message).filter_by(id=message_id).values(file_path=local_path))
+            await db.commit()
+
+def schedule_file_download(message_id: int, file_id: str, file_type: str):
+    task = asyncio.create_task(persist_file(message_id, file_id, file_type))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
 async def enqueue_user(db, user_id: int):
-    existing = db.query(UserQueue).filter_by(user_id=user_id).first()
-    if not existing:
-        queue_entry = UserQueue(user_id=user_id)
-        db.add(queue_entry)
-        db.commit()
+    stmt = sqlite_insert(UserQueue).values(
+        user_id=user_id,
+        created_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["user_id"])
+    await db.execute(stmt)
+    await db.commit()
 
 async def dequeue_next_user(db):
-    next_in_queue = db.query(UserQueue).order_by(UserQueue.created_at).first()
-    if next_in_queue:
-        user_id = next_in_queue.user_id
-        db.delete(next_in_queue)
-        db.commit()
-        return user_id
-    return None
+    return await db.scalar(DEQUEUE_NEXT_USER)
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if user.id in ADMIN_IDS:
         await update.message.reply_text(
             "Admin Control Panel",
-            reply_markup=admin_keyboard()
+            reply_markup=ADMIN_KB
         )
     else:
-        db = SessionLocal()
-        try:
-            get_or_create_user(db, user)
-            await update.message.reply_text("Hello! Send me a message and our support team will get back to you.")
-        finally:
-            db.close()
+        async with lock_for(user.id), AsyncSessionLocal() as db:
+            await get_or_create_user(db, user)
+        await update.message.reply_text("Hello! Send me a message and our support team will get back to you.")
 
 async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -247,38 +445,34 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat = update.effective_chat
     
     if chat.type in ['group', 'supergroup']:
-        await handle_group_message(update, context)
+        async with lock_for(chat.id):
+            await handle_group_message(update, context)
         return
     
     if user.id in ADMIN_IDS:
-        await handle_admin_message(update, context)
+        async with lock_for(chat.id):
+            await handle_admin_message(update, context)
         return
     
-    db = SessionLocal()
-    try:
-        db_user = get_or_create_user(db, user)
+    async with lock_for(user.id), AsyncSessionLocal() as db:
+        db_user = await get_or_create_user(db, user)
         
         content_type = "text"
         text_content = message.text
         file_id = None
-        file_path = None
         
         if message.photo:
             content_type = "photo"
             file_id = message.photo[-1].file_id
-            file_path = await download_file(file_id, "photo")
         elif message.video:
             content_type = "video"
             file_id = message.video.file_id
-            file_path = await download_file(file_id, "video")
         elif message.voice:
             content_type = "voice"
             file_id = message.voice.file_id
-            file_path = await download_file(file_id, "voice")
         elif message.document:
             content_type = "document"
             file_id = message.document.file_id
-            file_path = await download_file(file_id, "document")
         
         if message.caption:
             text_content = message.caption
@@ -288,46 +482,82 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             from_admin=False,
             content_type=content_type,
             text=text_content,
-            file_id=file_id,
-            file_path=file_path
+            file_id=file_id
         )
         db.add(msg_record)
-        db.commit()
+        await db.commit()
         
-        for admin_id in ADMIN_IDS:
-            session = get_active_session(db, admin_id)
-            if session and session.active_user_id == db_user.id:
-                msg_record.seen_by_admin = True
-                db.commit()
-                
-                await forward_message_to_admin(admin_id, db_user, message)
-                return
+        if file_id:
+            schedule_file_download(msg_record.id, file_id, content_type)
+        
+        admin_id = active_user_sessions.get(db_user.id)
+        if admin_id is not None:
+            msg_record.seen_by_admin = True
+            await db.commit()
+            
+            await forward_message_to_admin(admin_id, db_user, message)
+            return
         
         await enqueue_user(db, db_user.id)
         
-        auto_reply = await check_auto_reply(db, text_content)
+        auto_reply = await check_auto_reply(text_content)
         if auto_reply:
             reply_text, reply_photo = auto_reply
             if reply_photo:
                 await message.reply_photo(photo=reply_photo, caption=reply_text)
             else:
                 await message.reply_text(reply_text)
-        
-    finally:
-        db.close()
 
-async def check_auto_reply(db, text: Optional[str]):
+async def load_auto_replies():
+    global _auto_reply_cache
+    async with _auto_reply_lock:
+        cache = _auto_reply_cache
+        if cache is None:
+            generation = _auto_reply_generation
+            async with AsyncSessionLocal() as db:
+                auto_replies = (await db.scalars(select(AutoReply).order_by(AutoReply.id))).all()
+            entries = {ar.keyword: (ar.reply_text, ar.reply_photo_file_id) for ar in auto_replies}
+            automaton = ahocorasick.Automaton()
+            for priority, ar in enumerate(auto_replies):
+                keyword = ar.keyword.lower()
+                if keyword and keyword not in automaton:
+                    automaton.add_word(keyword, (priority, ar.reply_text, ar.reply_photo_file_id))
+            automaton.make_automaton()
+            cache = (entries, automaton)
+            if generation == _auto_reply_generation:
+                _auto_reply_cache = cache
+    return cache
+
+async def get_auto_replies():
+    cache = _auto_reply_cache
+    if cache is None:
+        cache = await load_auto_replies()
+    return cache[0]
+
+def invalidate_auto_replies():
+    global _auto_reply_cache, _auto_reply_generation
+    _auto_reply_generation += 1
+    _auto_reply_cache = None
+
+async def check_auto_reply(text: Optional[str]):
     if not text:
         return None
     
-    text_lower = text.lower()
-    auto_replies = db.query(AutoReply).all()
+    cache = _auto_reply_cache
+    if cache is None:
+        cache = await load_auto_replies()
+    automaton = cache[1]
+    if not len(automaton):
+        return None
     
-    for ar in auto_replies:
-        if ar.keyword.lower() in text_lower:
-            return (ar.reply_text, ar.reply_photo_file_id)
+    best = None
+    for _, match in automaton.iter(text.lower()):
+        if best is None or match[0] < best[0]:
+            best = match
+            if best[0] == 0:
+                break
     
-    return None
+    return (best[1], best[2]) if best else None
 
 async def forward_message_to_admin(admin_id: int, user, message):
     try:
@@ -373,9 +603,8 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
     if not message or not message.text:
         return
     
-    db = SessionLocal()
-    try:
-        group = get_or_create_group(db, chat)
+    async with AsyncSessionLocal() as db:
+        group = await get_or_create_group(db, chat)
         
         group_msg = GroupMessage(
             group_id=group.id,
@@ -385,109 +614,124 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
             text=message.text
         )
         db.add(group_msg)
-        db.commit()
-        
-        for admin_id in ADMIN_IDS:
-            session = get_active_session(db, admin_id)
-            if session and session.session_type == "group" and session.active_group_id == group.id:
-                prefix = f"👪 {group.title}\n@{user.username or user.id}: "
-                await bot_app.bot.send_message(
-                    chat_id=admin_id,
-                    text=prefix + message.text
-                )
-                return
-        
-        if message.text.startswith('/leaderboard'):
-            await show_leaderboard(update, group.id)
-            
-    finally:
-        db.close()
+        await db.execute(sqlite_insert(DailyGroupCount).values(
+            group_id=group.id,
+            username=user.username or "",
+            day=datetime.utcnow().date(),
+            message_count=1
+        ).on_conflict_do_update(
+            index_elements=["group_id", "username", "day"],
+            set_={"message_count": DailyGroupCount.message_count + 1}
+        ))
+        await db.commit()
+        
+        admin_id = active_group_sessions.get(group.id)
+        if admin_id is not None:
+            prefix = f"👪 {group.title}\n@{user.username or user.id}: "
+            await bot_app.bot.send_message(
+                chat_id=admin_id,
+                text=prefix + message.text
+            )
 
-async def show_leaderboard(update: Update, group_id: int):
-    db = SessionLocal()
-    try:
-        from sqlalchemy import func
-        period = "week"
-        
-        if update.message.text:
-            if "day" in update.message.text:
-                period = "day"
-            elif "month" in update.message.text:
-                period = "month"
-        
-        if period == "day":
-            time_ago = datetime.utcnow() - timedelta(days=1)
-        elif period == "week":
-            time_ago = datetime.utcnow() - timedelta(days=7)
-        else:
-            time_ago = datetime.utcnow() - timedelta(days=30)
-        
-        results = db.query(
-            GroupMessage.username,
-            func.count(GroupMessage.id).label('msg_count')
+async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with lock_for(update.effective_chat.id):
+        async with AsyncSessionLocal() as db:
+            group = await get_or_create_group(db, update.effective_chat)
+        await show_leaderboard(update, group.id)
+
+async def get_leaderboard(group_id: int, period: str):
+    if period == "day":
+        since = datetime.utcnow().date()
+    elif period == "week":
+        since = datetime.utcnow().date() - timedelta(days=6)
+    else:
+        since = datetime.utcnow().date() - timedelta(days=29)
+    
+    key = (group_id, period, since)
+    now = time.monotonic()
+    cached = leaderboard_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    async with AsyncSessionLocal() as db:
+        msg_count = func.sum(DailyGroupCount.message_count).label('msg_count')
+        results = (await db.execute(select(
+            DailyGroupCount.username,
+            msg_count
         ).filter(
-            GroupMessage.group_id == group_id,
-            GroupMessage.timestamp >= time_ago
-        ).group_by(GroupMessage.username).order_by(func.count(GroupMessage.id).desc()).limit(10).all()
-        
-        if not results:
-            await update.message.reply_text("No messages in this period!")
-            return
-        
-        text = f"📊 Leaderboard ({period.capitalize()}):\n\n"
-        for idx, (username, count) in enumerate(results, 1):
-            medal = "🥇" if idx == 1 else "🥈" if idx == 2 else "🥉" if idx == 3 else f"{idx}."
-            text += f"{medal} @{username or 'Unknown'}: {count} messages\n"
-        
-        await update.message.reply_text(text)
-    finally:
-        db.close()
+            DailyGroupCount.group_id == group_id,
+            DailyGroupCount.day >= since
+        ).group_by(DailyGroupCount.username).order_by(msg_count.desc()).limit(10))).all()
+    
+    for stale in [k for k, (expires, _) in leaderboard_cache.items() if expires <= now]:
+        del leaderboard_cache[stale]
+    leaderboard_cache[key] = (now + LEADERBOARD_CACHE_TTL, results)
+    return results
+
+async def show_leaderboard(update: Update, group_id: int):
+    period = "week"
+    
+    if update.message.text:
+        if "day" in update.message.text:
+            period = "day"
+        elif "month" in update.message.text:
+            period = "month"
+    
+    results = await get_leaderboard(group_id, period)
+    
+    if not results:
+        await update.message.reply_text("No messages in this period!")
+        return
+    
+    text = f"📊 Leaderboard ({period.capitalize()}):\n\n" + "".join(
+        f"{MEDALS[idx] if idx < len(MEDALS) else f'{idx + 1}.'} @{username or 'Unknown'}: {count} messages\n"
+        for idx, (username, count) in enumerate(results)
+    )
+    
+    await update.message.reply_text(text)
 
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_id = update.effective_user.id
     message = update.message
     
-    if admin_id in admin_state:
-        state = admin_state[admin_id]
-        
+    state = get_admin_state(admin_id)
+    if state:
         if state.get("awaiting") == "username_view":
             await handle_view_username(update, context, message.text)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
         elif state.get("awaiting") == "username_delete":
             await handle_delete_username(update, context, message.text)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
         elif state.get("awaiting") == "username_live":
             await handle_start_live_username(update, context, message.text)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
         elif state.get("awaiting") == "broadcast":
             await handle_broadcast_message(update, context)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
         elif state.get("awaiting") == "auto_reply_keyword":
-            admin_state[admin_id]["keyword"] = message.text
-            admin_state[admin_id]["awaiting"] = "auto_reply_text"
+            set_admin_state(admin_id, {"awaiting": "auto_reply_text", "keyword": message.text})
             await message.reply_text("Now send the reply text for this keyword:")
             return
         elif state.get("awaiting") == "auto_reply_text":
             photo_id = message.photo[-1].file_id if message.photo else None
             text = message.caption if message.photo else message.text
             await handle_add_auto_reply(update, context, state["keyword"], text, photo_id)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
         elif state.get("awaiting") == "auto_reply_delete_keyword":
             await handle_delete_auto_reply(update, context, message.text)
-            del admin_state[admin_id]
+            clear_admin_state(admin_id)
             return
     
-    db = SessionLocal()
-    try:
-        session = get_active_session(db, admin_id)
+    async with AsyncSessionLocal() as db:
+        session = await get_active_session(db, admin_id)
         
         if session and session.session_type == "group" and session.active_group_id:
-            group = db.query(Group).filter_by(id=session.active_group_id).first()
+            group = await db.scalar(select(Group).filter_by(id=session.active_group_id))
             if group:
                 try:
                     if message.photo:
@@ -520,7 +764,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
         
         if session and session.active_user_id:
-            user = db.query(User).filter_by(id=session.active_user_id).first()
+            user = await db.scalar(select(User).filter_by(id=session.active_user_id))
             if user:
                 content_type = "text"
                 text_content = message.text
@@ -551,7 +795,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     seen_by_admin=True
                 )
                 db.add(msg_record)
-                db.commit()
+                await db.commit()
                 
                 if user.telegram_id is None:
                     await message.reply_text(
@@ -595,9 +839,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     logger.error(f"Error sending message to user: {e}")
                     await message.reply_text(f"❌ Error sending message: {str(e)}")
         else:
-            await message.reply_text("No active session. Use the control panel to start a session.", reply_markup=admin_keyboard())
-    finally:
-        db.close()
+            await message.reply_text("No active session. Use the control panel to start a session.", reply_markup=ADMIN_KB)
 
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -622,66 +864,75 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     elif data == "leaderboard_menu":
         await show_leaderboard_menu(query)
     elif data == "view_user":
-        admin_state[user_id] = {"awaiting": "username_view"}
+        set_admin_state(user_id, {"awaiting": "username_view"})
         await query.message.reply_text("Send the username (with or without @):")
     elif data == "delete_all":
-        keyboard = [
-            [InlineKeyboardButton("✅ Yes, delete all", callback_data="confirm_delete_all"),
-             InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-        ]
         await query.message.reply_text(
             "⚠️ Are you sure you want to delete ALL chat history?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=DELETE_ALL_CONFIRM_KB
         )
     elif data == "confirm_delete_all":
         await delete_all_chats(query)
     elif data == "delete_user":
-        admin_state[user_id] = {"awaiting": "username_delete"}
+        set_admin_state(user_id, {"awaiting": "username_delete"})
         await query.message.reply_text("Send the username to delete (with or without @):")
     elif data == "start_live":
-        admin_state[user_id] = {"awaiting": "username_live"}
+        set_admin_state(user_id, {"awaiting": "username_live"})
         await query.message.reply_text("Send the username to start live session (with or without @):")
     elif data == "end_live":
         await end_live_session(query)
     elif data == "broadcast":
-        admin_state[user_id] = {"awaiting": "broadcast"}
+        set_admin_state(user_id, {"awaiting": "broadcast"})
         await query.message.reply_text("Send the message to broadcast (text or media with caption):")
     elif data == "auto_replies":
         await show_auto_replies_menu(query)
     elif data == "add_auto_reply":
-        admin_state[user_id] = {"awaiting": "auto_reply_keyword"}
+        set_admin_state(user_id, {"awaiting": "auto_reply_keyword"})
         await query.message.reply_text("Send the keyword for auto-reply:")
     elif data == "delete_auto_reply":
-        admin_state[user_id] = {"awaiting": "auto_reply_delete_keyword"}
+        set_admin_state(user_id, {"awaiting": "auto_reply_delete_keyword"})
         await query.message.reply_text("Send the keyword to delete:")
     elif data == "list_auto_replies":
         await list_auto_replies(query)
     elif data.startswith("view_history_"):
-        user_id_to_view = int(data.split("_")[-2])
-        page = int(data.split("_")[-1])
-        await show_user_history(query, user_id_to_view, page)
+        parts = data.split("_")
+        user_id_to_view = int(parts[2])
+        page = int(parts[3])
+        cursor = parts[4] if len(parts) > 4 else None
+        await show_user_history(query, user_id_to_view, page, cursor)
     elif data == "cancel":
-        await query.message.reply_text("Cancelled", reply_markup=admin_keyboard())
+        await query.message.reply_text("Cancelled", reply_markup=ADMIN_KB)
 
 async def show_users_page(query, page: int):
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         per_page = 10
         offset = (page - 1) * per_page
         
-        users = db.query(User).order_by(User.last_seen.desc()).limit(per_page).offset(offset).all()
-        total_users = db.query(User).count()
+        rows = (await db.execute(
+            select(User, func.count().over().label("total"))
+            .order_by(User.last_seen.desc()).limit(per_page).offset(offset)
+        )).all()
+        users = [row[0] for row in rows]
+        total_users = rows[0][1] if rows else 0
         total_pages = (total_users + per_page - 1) // per_page
         
         if not users:
             await query.message.reply_text("No users found")
             return
         
-        text = f"👥 Users (Page {page}/{total_pages}):\n\n"
-        
-        for user in users:
-            unread_count = db.query(Message).filter_by(user_id=user.id, from_admin=False, seen_by_admin=False).count()
-            text += f"@{user.username or user.telegram_id} - {unread_count} unread\n"
+        unread_counts = dict((await db.execute(select(
+            Message.user_id,
+            func.count(Message.id)
+        ).filter(
+            Message.user_id.in_([user.id for user in users]),
+            Message.from_admin.is_(False),
+            Message.seen_by_admin.is_(False)
+        ).group_by(Message.user_id))).all())
+        
+        text = f"👥 Users (Page {page}/{total_pages}):\n\n" + "".join(
+            f"@{user.username or user.telegram_id} - {unread_counts.get(user.id, 0)} unread\n"
+            for user in users
+        )
         
         keyboard = []
         nav_buttons = []
@@ -693,30 +944,31 @@ async def show_users_page(query, page: int):
         if nav_buttons:
             keyboard.append(nav_buttons)
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")])
+        keyboard.append(BACK_ROW)
         
         await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
 
 async def show_groups_page(query, page: int):
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         per_page = 10
         offset = (page - 1) * per_page
         
-        groups = db.query(Group).order_by(Group.last_seen.desc()).limit(per_page).offset(offset).all()
-        total_groups = db.query(Group).count()
+        rows = (await db.execute(
+            select(Group, func.count().over().label("total"))
+            .order_by(Group.last_seen.desc()).limit(per_page).offset(offset)
+        )).all()
+        groups = [row[0] for row in rows]
+        total_groups = rows[0][1] if rows else 0
         total_pages = (total_groups + per_page - 1) // per_page
         
         if not groups:
             await query.message.reply_text("No groups found. Add the bot to groups first!")
             return
         
-        text = f"👪 Groups (Page {page}/{total_pages}):\n\n"
-        
-        for idx, group in enumerate(groups, start=offset+1):
-            text += f"{idx}. {group.title}\n"
+        text = f"👪 Groups (Page {page}/{total_pages}):\n\n" + "".join(
+            f"{idx}. {group.title}\n"
+            for idx, group in enumerate(groups, start=offset+1)
+        )
         
         keyboard = []
         group_buttons = []
@@ -737,22 +989,19 @@ async def show_groups_page(query, page: int):
         if nav_buttons:
             keyboard.append(nav_buttons)
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")])
+        keyboard.append(BACK_ROW)
         
         await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
 
 async def start_group_session(query, group_id: int):
-    db = SessionLocal()
-    try:
-        group = db.query(Group).filter_by(id=group_id).first()
+    async with AsyncSessionLocal() as db:
+        group = await db.scalar(select(Group).filter_by(id=group_id))
         if not group:
             await query.message.reply_text("Group not found!")
             return
         
         admin_id = query.from_user.id
-        existing_session = get_active_session(db, admin_id)
+        existing_session = await get_active_session(db, admin_id)
         if existing_session:
             existing_session.is_active = False
             existing_session.ended_at = datetime.utcnow()
@@ -765,7 +1014,15 @@ async def start_group_session(query, group_id: int):
             started_at=datetime.utcnow()
         )
         db.add(new_session)
-        db.commit()
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            await query.message.reply_text("You already have an active session. End it first.")
+            return
+        if existing_session:
+            untrack_session(existing_session)
+        track_session(new_session)
         
         await query.message.reply_text(
             f"✅ Live session started with group: {group.title}\n"
@@ -773,328 +1030,295 @@ async def start_group_session(query, group_id: int):
             f"Your messages will be sent to the group.\n\n"
             f"Use 'End live session' button to stop."
         )
-    finally:
-        db.close()
 
 async def show_leaderboard_menu(query):
-    keyboard = [
-        [InlineKeyboardButton("📊 Day Leaders", callback_data="lb_day"),
-         InlineKeyboardButton("📊 Week Leaders", callback_data="lb_week")],
-        [InlineKeyboardButton("📊 Month Leaders", callback_data="lb_month")],
-        [InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")]
-    ]
     await query.message.reply_text(
         "Select leaderboard period:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=LEADERBOARD_MENU_KB
     )
 
 async def handle_view_username(update: Update, context: ContextTypes.DEFAULT_TYPE, username: str):
     username = username.lstrip("@")
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter_by(username=username).first()
-        if not user:
-            await update.message.reply_text(f"User @{username} not found")
-            return
-        
-        await show_user_history_direct(update.message, user.id, 1)
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).filter(func.lower(User.username) == username.lower()))
+    if not user:
+        await update.message.reply_text(f"User @{username} not found")
+        return
+    
+    await show_user_history_direct(update.message, user.id, 1)
 
-async def show_user_history(query, user_id: int, page: int):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            await query.message.reply_text("User not found")
-            return
-        
-        per_page = 10
-        offset = (page - 1) * per_page
-        
-        messages = db.query(Message).filter_by(user_id=user_id).order_by(Message.timestamp.desc()).limit(per_page).offset(offset).all()
-        total_messages = db.query(Message).filter_by(user_id=user_id).count()
-        total_pages = (total_messages + per_page - 1) // per_page
-        
-        if not messages:
-            await query.message.reply_text("No messages found")
-            return
-        
-        text = f"💬 Chat history with @{user.username or user.telegram_id} (Page {page}/{total_pages}):\n\n"
-        
-        for msg in reversed(messages):
-            sender = "Admin" if msg.from_admin else "User"
-            timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M")
-            text += f"[{timestamp}] {sender}: "
-            if msg.content_type == "text":
-                text += f"{msg.text[:50]}...\n" if msg.text and len(msg.text) > 50 else f"{msg.text}\n"
-            else:
-                text += f"[{msg.content_type}]\n"
-        
-        keyboard = []
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"view_history_{user_id}_{page-1}"))
-        if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=f"view_history_{user_id}_{page+1}"))
-        
-        if nav_buttons:
-            keyboard.append(nav_buttons)
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")])
-        
-        await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
+def format_history_line(msg):
+    sender = "Admin" if msg.from_admin else "User"
+    timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M")
+    if msg.content_type != "text":
+        body = f"[{msg.content_type}]"
+    elif msg.text and len(msg.text) > 50:
+        body = f"{msg.text[:50]}..."
+    else:
+        body = f"{msg.text}"
+    return f"[{timestamp}] {sender}: {body}\n"
 
-async def show_user_history_direct(message, user_id: int, page: int):
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter_by(id=user_id).first()
+async def render_user_history(user_id: int, page: int, cursor: Optional[str] = None):
+    async with AsyncSessionLocal() as db:
+        user = await db.scalar(select(User).filter_by(id=user_id))
         if not user:
-            await message.reply_text("User not found")
-            return
+            return "User not found", None
         
         per_page = 10
-        offset = (page - 1) * per_page
+        newer = False
+        stmt = select(Message).filter_by(user_id=user_id)
+        order_by = (Message.timestamp.desc(), Message.id.desc())
+        
+        anchor = await db.get(Message, int(cursor[1:])) if cursor else None
+        if anchor and anchor.user_id == user_id:
+            key = tuple_(Message.timestamp, Message.id)
+            anchor_key = tuple_(anchor.timestamp, anchor.id)
+            if cursor[0] == "n":
+                newer = True
+                stmt = stmt.where(key > anchor_key)
+                order_by = (Message.timestamp, Message.id)
+            else:
+                stmt = stmt.where(key < anchor_key)
+        else:
+            anchor = None
+            page = 1
         
-        messages = db.query(Message).filter_by(user_id=user_id).order_by(Message.timestamp.desc()).limit(per_page).offset(offset).all()
-        total_messages = db.query(Message).filter_by(user_id=user_id).count()
-        total_pages = (total_messages + per_page - 1) // per_page
+        messages = (await db.scalars(stmt.order_by(*order_by).limit(per_page + 1))).all()
+        has_more = len(messages) > per_page
+        messages = messages[:per_page]
+        if newer:
+            messages.reverse()
         
         if not messages:
-            await message.reply_text("No messages found")
-            return
+            return "No messages found", None
         
-        text = f"💬 Chat history with @{user.username or user.telegram_id} (Page {page}/{total_pages}):\n\n"
+        has_newer = has_more if newer else anchor is not None
+        has_older = True if newer else has_more
         
-        for msg in reversed(messages):
-            sender = "Admin" if msg.from_admin else "User"
-            timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M")
-            text += f"[{timestamp}] {sender}: "
-            if msg.content_type == "text":
-                text += f"{msg.text[:50]}...\n" if msg.text and len(msg.text) > 50 else f"{msg.text}\n"
-            else:
-                text += f"[{msg.content_type}]\n"
+        text = f"💬 Chat history with @{user.username or user.telegram_id} (Page {page}):\n\n" + "".join(
+            format_history_line(msg) for msg in reversed(messages)
+        )
         
         keyboard = []
         nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"view_history_{user_id}_{page-1}"))
-        if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=f"view_history_{user_id}_{page+1}"))
+        if has_newer:
+            nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"view_history_{user_id}_{max(page - 1, 1)}_n{messages[0].id}"))
+        if has_older:
+            nav_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=f"view_history_{user_id}_{page + 1}_o{messages[-1].id}"))
         
         if nav_buttons:
             keyboard.append(nav_buttons)
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")])
+        keyboard.append(BACK_ROW)
         
-        await message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-    finally:
-        db.close()
+        return text, InlineKeyboardMarkup(keyboard)
+
+async def show_user_history(query, user_id: int, page: int, cursor: Optional[str] = None):
+    await show_user_history_direct(query.message, user_id, page, cursor)
+
+async def show_user_history_direct(message, user_id: int, page: int, cursor: Optional[str] = None):
+    text, reply_markup = await render_user_history(user_id, page, cursor)
+    await message.reply_text(text, reply_markup=reply_markup)
 
 async def delete_all_chats(query):
-    db = SessionLocal()
-    try:
-        db.query(Message).delete()
-        db.query(UserQueue).delete()
-        db.query(AdminSession).update({"is_active": False, "ended_at": datetime.utcnow()})
-        db.commit()
-        await query.message.reply_text("✅ All chat history deleted", reply_markup=admin_keyboard())
-    except Exception as e:
-        logger.error(f"Error deleting all chats: {e}")
-        await query.message.reply_text(f"❌ Error: {str(e)}")
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.execute(delete(Message), execution_options={"synchronize_session": False})
+            await db.execute(delete(UserQueue), execution_options={"synchronize_session": False})
+            await db.execute(
+                sql_update(AdminSession).where(AdminSession.is_active.is_(True)).values(is_active=False, ended_at=datetime.utcnow()),
+                execution_options={"synchronize_session": False}
+            )
+            await db.commit()
+            active_user_sessions.clear()
+            active_group_sessions.clear()
+            await query.message.reply_text("✅ All chat history deleted", reply_markup=ADMIN_KB)
+        except Exception as e:
+            logger.error(f"Error deleting all chats: {e}")
+            await query.message.reply_text(f"❌ Error: {str(e)}")
 
 async def handle_delete_username(update: Update, context: ContextTypes.DEFAULT_TYPE, username: str):
     username = username.lstrip("@")
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter_by(username=username).first()
-        if not user:
-            await update.message.reply_text(f"User @{username} not found")
-            return
-        
-        db.query(Message).filter_by(user_id=user.id).delete()
-        db.query(UserQueue).filter_by(user_id=user.id).delete()
-        db.commit()
-        
-        await update.message.reply_text(f"✅ Chat history for @{username} deleted", reply_markup=admin_keyboard())
-    except Exception as e:
-        logger.error(f"Error deleting user chats: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await db.scalar(select(User).filter(func.lower(User.username) == username.lower()))
+            if not user:
+                await update.message.reply_text(f"User @{username} not found")
+                return
+            
+            await db.execute(delete(Message).filter_by(user_id=user.id))
+            await db.execute(delete(UserQueue).filter_by(user_id=user.id))
+            await db.commit()
+            
+            await update.message.reply_text(f"✅ Chat history for @{username} deleted", reply_markup=ADMIN_KB)
+        except Exception as e:
+            logger.error(f"Error deleting user chats: {e}")
+            await update.message.reply_text(f"❌ Error: {str(e)}")
 
 async def handle_start_live_username(update: Update, context: ContextTypes.DEFAULT_TYPE, username: str):
     username = username.lstrip("@")
     admin_id = update.effective_user.id
     
-    db = SessionLocal()
-    try:
-        async with session_lock:
-            existing_session = get_active_session(db, admin_id)
-            if existing_session:
-                await update.message.reply_text("You already have an active session. End it first.")
-                return
-            
-            from sqlalchemy import func
-            user = db.query(User).filter(func.lower(User.username) == username.lower()).first()
-            user_is_new = False
-            user_not_contacted = False
-            
-            if not user:
-                user = User(telegram_id=None, username=username)
-                db.add(user)
-                db.commit()
-                db.refresh(user)
-                user_is_new = True
-                user_not_contacted = True
-            elif user.telegram_id is None:
-                user_not_contacted = True
-            
-            session = AdminSession(
-                admin_id=admin_id,
-                active_user_id=user.id,
-                is_active=True,
-                started_at=datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        existing_session = await get_active_session(db, admin_id)
+        if existing_session:
+            await update.message.reply_text("You already have an active session. End it first.")
+            return
+        
+        user = await db.scalar(select(User).filter(func.lower(User.username) == username.lower()))
+        user_is_new = False
+        user_not_contacted = False
+        
+        if not user:
+            user = User(telegram_id=None, username=username)
+            db.add(user)
+            await db.commit()
+            await db.refresh(user)
+            user_is_new = True
+            user_not_contacted = True
+        elif user.telegram_id is None:
+            user_not_contacted = True
+        
+        session = AdminSession(
+            admin_id=admin_id,
+            active_user_id=user.id,
+            session_type="user",
+            is_active=True,
+            started_at=datetime.utcnow()
+        )
+        db.add(session)
+        try:
+            await db.flush()
+        except IntegrityError:
+            await db.rollback()
+            await update.message.reply_text("You already have an active session. End it first.")
+            return
+        
+        await db.execute(delete(UserQueue).filter_by(user_id=user.id))
+        
+        await db.execute(sql_update(Message).filter_by(user_id=user.id, from_admin=False).values(seen_by_admin=True))
+        
+        await db.commit()
+        track_session(session)
+        
+        if user_not_contacted:
+            await update.message.reply_text(
+                f"✅ Live session started with @{username}\n\n"
+                f"⚠️ Note: This user hasn't messaged the bot yet, so you cannot send messages to them until they contact the bot first.",
+                reply_markup=ADMIN_KB
+            )
+        else:
+            await update.message.reply_text(
+                f"✅ Live session started with @{username}\nYou can now chat directly. Messages will be forwarded in real-time.",
+                reply_markup=ADMIN_KB
             )
-            db.add(session)
-            
-            db.query(UserQueue).filter_by(user_id=user.id).delete()
-            
-            db.query(Message).filter_by(user_id=user.id, from_admin=False).update({"seen_by_admin": True})
-            
-            db.commit()
-            
-            if user_not_contacted:
-                await update.message.reply_text(
-                    f"✅ Live session started with @{username}\n\n"
-                    f"⚠️ Note: This user hasn't messaged the bot yet, so you cannot send messages to them until they contact the bot first.",
-                    reply_markup=admin_keyboard()
-                )
-            else:
-                await update.message.reply_text(
-                    f"✅ Live session started with @{username}\nYou can now chat directly. Messages will be forwarded in real-time.",
-                    reply_markup=admin_keyboard()
-                )
-    finally:
-        db.close()
 
 async def end_live_session(query):
     admin_id = query.from_user.id
-    db = SessionLocal()
-    try:
-        async with session_lock:
-            session = get_active_session(db, admin_id)
+    async with AsyncSessionLocal() as db:
+        async with lock_for(admin_id):
+            session = await get_active_session(db, admin_id)
             if not session:
                 await query.message.reply_text("No active session to end")
                 return
             
             session.is_active = False
             session.ended_at = datetime.utcnow()
-            db.commit()
+            await db.commit()
+            untrack_session(session)
             
             next_user_id = await dequeue_next_user(db)
             
             if next_user_id:
-                user = db.query(User).filter_by(id=next_user_id).first()
+                user = await db.scalar(select(User).filter_by(id=next_user_id))
                 if user:
                     new_session = AdminSession(
                         admin_id=admin_id,
                         active_user_id=user.id,
+                        session_type="user",
                         is_active=True,
                         started_at=datetime.utcnow()
                     )
                     db.add(new_session)
-                    db.commit()
-                    
-                    unread_messages = db.query(Message).filter_by(
+                    try:
+                        await db.flush()
+                    except IntegrityError:
+                        await db.rollback()
+                        await query.message.reply_text("You already have an active session. End it first.")
+                        return
+                    await db.execute(sql_update(Message).filter_by(
                         user_id=user.id,
                         from_admin=False,
                         seen_by_admin=False
-                    ).order_by(Message.timestamp).all()
-                    
-                    for msg in unread_messages:
-                        msg.seen_by_admin = True
-                    db.commit()
+                    ).values(seen_by_admin=True))
+                    await db.commit()
+                    track_session(new_session)
                     
                     await query.message.reply_text(
                         f"✅ Session ended. Starting new session with @{user.username or user.telegram_id} (next in queue)",
-                        reply_markup=admin_keyboard()
+                        reply_markup=ADMIN_KB
                     )
                     return
             
-            await query.message.reply_text("✅ Session ended. No users in queue.", reply_markup=admin_keyboard())
-    finally:
-        db.close()
+            await db.commit()
+            await query.message.reply_text("✅ Session ended. No users in queue.", reply_markup=ADMIN_KB)
+
+async def deliver_broadcast(message, chat_id: int):
+    await bot_app.bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=message.chat_id,
+        message_id=message.message_id
+    )
+
+async def send_broadcast(message, chat_id: int):
+    async with broadcast_semaphore:
+        try:
+            await deliver_broadcast(message, chat_id)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            await deliver_broadcast(message, chat_id)
+        await asyncio.sleep(1)
 
 async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
-    db = SessionLocal()
-    try:
-        users = db.query(User).all()
-        
-        success_count = 0
-        fail_count = 0
-        
-        for user in users:
-            try:
-                if message.photo:
-                    await bot_app.bot.send_photo(
-                        chat_id=user.telegram_id,
-                        photo=message.photo[-1].file_id,
-                        caption=message.caption
-                    )
-                elif message.video:
-                    await bot_app.bot.send_video(
-                        chat_id=user.telegram_id,
-                        video=message.video.file_id,
-                        caption=message.caption
-                    )
-                elif message.voice:
-                    await bot_app.bot.send_voice(
-                        chat_id=user.telegram_id,
-                        voice=message.voice.file_id
-                    )
-                elif message.document:
-                    await bot_app.bot.send_document(
-                        chat_id=user.telegram_id,
-                        document=message.document.file_id,
-                        caption=message.caption
-                    )
-                else:
-                    await bot_app.bot.send_message(
-                        chat_id=user.telegram_id,
-                        text=message.text
-                    )
-                success_count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Error broadcasting to {user.telegram_id}: {e}")
-                fail_count += 1
-        
-        await message.reply_text(
-            f"📢 Broadcast complete!\n✅ Sent: {success_count}\n❌ Failed: {fail_count}",
-            reply_markup=admin_keyboard()
+    success_count = 0
+    fail_count = 0
+    
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            chunk = (await db.execute(
+                select(User.id, User.telegram_id)
+                .where(User.telegram_id.isnot(None), User.id > last_id)
+                .order_by(User.id)
+                .limit(BROADCAST_CHUNK_SIZE)
+            )).all()
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        
+        results = await asyncio.gather(
+            *(send_broadcast(message, telegram_id) for _, telegram_id in chunk),
+            return_exceptions=True
         )
-    finally:
-        db.close()
+        for (_, telegram_id), result in zip(chunk, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error broadcasting to {telegram_id}: {result}")
+                fail_count += 1
+            else:
+                success_count += 1
+    
+    await message.reply_text(
+        f"📢 Broadcast complete!\n✅ Sent: {success_count}\n❌ Failed: {fail_count}",
+        reply_markup=ADMIN_KB
+    )
 
 async def show_auto_replies_menu(query):
-    keyboard = [
-        [InlineKeyboardButton("➕ Add Auto Reply", callback_data="add_auto_reply")],
-        [InlineKeyboardButton("➖ Delete Auto Reply", callback_data="delete_auto_reply")],
-        [InlineKeyboardButton("📋 List Auto Replies", callback_data="list_auto_replies")],
-        [InlineKeyboardButton("🔙 Back to menu", callback_data="cancel")]
-    ]
-    await query.message.reply_text("🤖 Auto Replies Menu:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await query.message.reply_text("🤖 Auto Replies Menu:", reply_markup=AUTO_REPLIES_MENU_KB)
 
 async def handle_add_auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, keyword: str, reply_text: str, photo_file_id: str = None):
-    db = SessionLocal()
-    try:
-        existing = db.query(AutoReply).filter_by(keyword=keyword).first()
+    async with AsyncSessionLocal() as db:
+        existing = await db.scalar(select(AutoReply).filter_by(keyword=keyword))
         if existing:
             existing.reply_text = reply_text
             if photo_file_id:
@@ -1102,55 +1326,65 @@ async def handle_add_auto_reply(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             auto_reply = AutoReply(keyword=keyword, reply_text=reply_text, reply_photo_file_id=photo_file_id)
             db.add(auto_reply)
-        db.commit()
+        await db.commit()
+        invalidate_auto_replies()
         
         await update.message.reply_text(
             f"✅ Auto-reply added!\nKeyword: {keyword}\nReply: {reply_text}",
-            reply_markup=admin_keyboard()
+            reply_markup=ADMIN_KB
         )
-    finally:
-        db.close()
 
 async def handle_delete_auto_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, keyword: str):
-    db = SessionLocal()
-    try:
-        auto_reply = db.query(AutoReply).filter_by(keyword=keyword).first()
+    async with AsyncSessionLocal() as db:
+        auto_reply = await db.scalar(select(AutoReply).filter_by(keyword=keyword))
         if auto_reply:
-            db.delete(auto_reply)
-            db.commit()
-            await update.message.reply_text(f"✅ Auto-reply for '{keyword}' deleted", reply_markup=admin_keyboard())
+            await db.delete(auto_reply)
+            await db.commit()
+            invalidate_auto_replies()
+            await update.message.reply_text(f"✅ Auto-reply for '{keyword}' deleted", reply_markup=ADMIN_KB)
         else:
             await update.message.reply_text(f"❌ No auto-reply found for '{keyword}'")
-    finally:
-        db.close()
 
 async def list_auto_replies(query):
-    db = SessionLocal()
-    try:
-        auto_replies = db.query(AutoReply).all()
-        
-        if not auto_replies:
-            await query.message.reply_text("No auto-replies configured")
-            return
-        
-        text = "🤖 Configured Auto Replies:\n\n"
-        for ar in auto_replies:
-            text += f"Keyword: {ar.keyword}\nReply: {ar.reply_text}\n\n"
-        
-        await query.message.reply_text(text, reply_markup=admin_keyboard())
-    finally:
-        db.close()
+    auto_replies = await get_auto_replies()
+    
+    if not auto_replies:
+        await query.message.reply_text("No auto-replies configured")
+        return
+    
+    text = "🤖 Configured Auto Replies:\n\n" + "".join(
+        f"Keyword: {keyword}\nReply: {reply_text}\n\n"
+        for keyword, (reply_text, _) in auto_replies.items()
+    )
+    
+    await query.message.reply_text(text, reply_markup=ADMIN_KB)
+
+async def process_updates():
+    while True:
+        update = await update_queue.get()
+        try:
+            await bot_app.process_update(update)
+        except Exception as e:
+            logger.error(f"Error processing update: {e}")
+        finally:
+            update_queue.task_done()
 
 async def setup_telegram_app():
     global bot_app
-    bot_app = Application.builder().token(TELEGRAM_TOKEN).build()
+    bot_app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .build()
+    )
     
     bot_app.add_handler(CommandHandler("start", start_command))
+    bot_app.add_handler(CommandHandler("leaderboard", leaderboard_command, filters=filters.ChatType.GROUPS))
     bot_app.add_handler(CallbackQueryHandler(callback_query_handler))
     bot_app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_user_message))
     
     await bot_app.initialize()
     await bot_app.start()
+    update_workers.extend(asyncio.create_task(process_updates()) for _ in range(UPDATE_WORKERS))
     
     await bot_app.bot.set_chat_menu_button(menu_button={"type": "commands"})
     await bot_app.bot.set_my_commands([])
@@ -1158,20 +1392,34 @@ async def setup_telegram_app():
     
     if WEBHOOK_URL:
         full_webhook_url = f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}"
-        await bot_app.bot.set_webhook(url=full_webhook_url)
+        await bot_app.bot.set_webhook(url=full_webhook_url, max_connections=100)
         logger.info("Webhook configured successfully")
 
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    await init_db()
+    await optimize_db()
+    async with AsyncSessionLocal() as db:
+        await backfill_daily_group_counts(db)
+        await load_active_sessions(db)
+    await load_auto_replies()
     await setup_telegram_app()
     logger.info("Bot started successfully")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await update_queue.join()
+    for worker in update_workers:
+        worker.cancel()
     if bot_app:
         await bot_app.stop()
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    if bot_app:
         await bot_app.shutdown()
+    file_io_executor.shutdown(wait=True)
+    await optimize_db()
+    await engine.dispose()
 
 @app.get("/")
 async def root():
@@ -1179,15 +1427,18 @@ async def root():
 
 @app.post("/webhook/{secret}")
 async def telegram_webhook(secret: str, request: Request):
-    if secret != WEBHOOK_SECRET:
+    if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET_BYTES):
         logger.warning("Webhook called with invalid secret")
         raise HTTPException(status_code=403, detail="Invalid secret")
     
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         update = Update.de_json(data, bot_app.bot)
-        await bot_app.process_update(update)
-        return {"ok": True}
+        update_queue.put_nowait(update)
+        return Response(status_code=200)
+    except asyncio.QueueFull:
+        logger.warning("Update queue full, asking Telegram to retry")
+        raise HTTPException(status_code=503, detail="Update queue full")
     except Exception as e:
         logger.error(f"Error processing webhook: {e}", exc_info=True)
         return {"ok": False, "error": str(e)}